@@ -9,30 +9,256 @@ autodeploy_chat.py
 A unified script to automate application deployment using an LLM to orchestrate
 the entire process from natural language input to cloud provisioning via Terraform.
 """
+import functools
+import hashlib
+import itertools
 import json
 import os
 import re
 import shutil
 import subprocess
 import sys
+from collections import deque
+import threading
+import time
 import random
 import string
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import orjson  # optional: faster JSON parse/serialize on the LLM-response path
+except ImportError:
+    orjson = None
 from pathlib import Path
-from urllib.parse import urlparse
 
 os.environ['OPENROUTER_API_KEY'] = ''
 os.environ["GCP_BILLING_ACCOUNT_ID"] = ''
 
+# On-disk cache for GitHub tree responses (and other per-user caches)
+CACHE_DIR = Path(os.getenv("AUTODEPLOY_CACHE_DIR", Path.home() / ".cache" / "autodeploy"))
+
+# Apply with more concurrent provider calls than the default 10 (AUTODEPLOY_TF_PARALLELISM, capped at
+# TF_MAX_PARALLELISM); wait on a held state lock instead of failing
+TF_MAX_PARALLELISM = 50
+try:
+    TF_PARALLELISM = max(1, min(int(os.getenv("AUTODEPLOY_TF_PARALLELISM", "30")), TF_MAX_PARALLELISM))
+except ValueError:
+    TF_PARALLELISM = 30  # non-numeric override: keep the default rather than dying at import
+TF_APPLY_CMD = ["terraform", "apply", "-auto-approve", "-input=false", f"-parallelism={TF_PARALLELISM}",
+                "-lock-timeout=5m"]
+# Never prompt during init; providers come from the shared plugin cache (see terraform_env)
+TF_INIT_CMD = ["terraform", "init", "-reconfigure", "-input=false"]
+
+# APIs every GCP deployment needs; enabled together in one gcloud call
+GCP_SERVICES_NEEDED = ("compute.googleapis.com",)
+# Existing projects probed (read-only, concurrently) when a new one cannot be created
+GCP_MAX_PROJECT_CANDIDATES = 16
+
+# GCP REST endpoints used to prepare projects without a gcloud cold start per call
+_GCP_CRM_API = "https://cloudresourcemanager.googleapis.com/v1"
+_GCP_BILLING_API = "https://cloudbilling.googleapis.com/v1"
+_GCP_SERVICEUSAGE_API = "https://serviceusage.googleapis.com/v1"
+
+# Matches gcloud's project-quota errors (case-insensitive, single pass over stderr+stdout)
+_QUOTA_RE = re.compile(r"exceeded your allotted project quota|quotafailure|quota", re.I)
+
+# GitHub repo URLs (https, scheme-less or git@), optionally ending in .git or /tree/<ref>
+# (refs may contain slashes); any ?query or #fragment is ignored
+_GH_URL_RE = re.compile(
+    r"^(?:git@github\.com:|(?:https?://)?(?:www\.)?github\.com/)(?P<owner>[^/?#]+)/(?P<repo>[^/?#]+?)(?:\.git)?"
+    r"(?:/tree/(?P<ref>[^?#]+?))?/?(?:[?#].*)?$"
+)
+
+# Cloud-provider names as normalized by the intent LLM
+_GCP_RE = re.compile(r'\b(gcp|google\s+cloud|google\s+cloud\s+platform)\b', re.I)
+_AZURE_RE = re.compile(r'\b(azure|microsoft\s+azure)\b', re.I)
+_AWS_RE = re.compile(r'\b(aws|amazon\s+web\s+services|amazon)\b', re.I)
+_INSTANCE_TYPE_RE = re.compile(r"[a-z0-9]+\.[a-z0-9]+")
+
+# ---------------- Shared HTTP session ----------------
+def _make_session() -> requests.Session:
+    """One keep-alive session for LLM + GitHub calls, retrying 429/5xx with exponential backoff."""
+    retry = Retry(
+        total=3, backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST"]),
+        raise_on_status=False,  # hand the last response back so raise_for_status() reports it
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+    return session
+
+_SESSION = _make_session()
+
+
+@functools.lru_cache(maxsize=1)
+def _http2_client():
+    """
+    httpx HTTP/2 client for LLM calls, or None when httpx / h2 aren't installed (requests is used then).
+    Optional dependency (pip install "httpx[http2]"), imported on first use since it is a heavy import;
+    main() warms it in the background while the user is still typing.
+    """
+    try:
+        import httpx
+        # With an explicit transport, httpx.Client ignores its own limits=, so the pool is sized here.
+        # retries only re-attempts failed connections; 429/5xx responses are not retried.
+        return httpx.Client(
+            http2=True, timeout=60,
+            transport=httpx.HTTPTransport(
+                http2=True, retries=3,
+                limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+            ),
+        )
+    except ImportError:  # no httpx, or http2=True without the `h2` package
+        return None
+
+
 # ---------------- Provider-agnostic chat helper ----------------
-def chat_complete(messages, model=None, provider=None, timeout=60):
+_JSON_DECODER = json.JSONDecoder()
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+def _strip_json_fence(text: str) -> str:
+    """Drop a leading ``` / ```json fence the model sometimes wraps JSON in."""
+    s = (text or "").strip()
+    if s.startswith("```"):
+        s = s[3:]
+        if s[:4].lower() == "json":
+            s = s[4:]
+        s = s.strip()
+    return s
+
+def loads_llm_json(text: str):
+    """
+    Parse the JSON object in an LLM reply, tolerating code fences, leading prose and trailing text
+    (so formatting drift doesn't cost a rerun). Raises ValueError if there is no valid JSON.
+    """
+    s = _strip_json_fence(text)
+    try:
+        return _json_loads(s)  # fast path: the whole reply is JSON
+    except ValueError:
+        pass
+    # Salvage the first {...} region; raw_decode stops at its end, so trailing text is ignored
+    i = s.find("{")
+    if i < 0:
+        raise ValueError("no JSON object in LLM reply")
+    obj, _ = _JSON_DECODER.raw_decode(s, i)
+    return obj
+
+_PREFERRED_PORTS = (80, 8080, 5000, 8000)
+
+def prefer_port(ports, default: int = 8000) -> int:
+    """
+    Coerce the model's `app_port` (an int, a numeric string, or a list of either) to one port.
+    Single pass: a well-known web port wins, otherwise the first valid one, otherwise `default`
+    (with a warning, since the app may not actually listen there).
+    """
+    if ports is None or isinstance(ports, (int, float, str)):
+        ports = (ports,)
+    seen, first = set(), None
+    for p in ports:
+        if isinstance(p, bool):
+            continue
+        if isinstance(p, (int, float)):
+            v = int(p)
+        elif isinstance(p, str) and p.strip().isdigit():
+            v = int(p.strip())
+        else:
+            continue
+        if not 0 < v < 65536:
+            continue
+        if first is None:
+            first = v
+        seen.add(v)
+    for c in _PREFERRED_PORTS:
+        if c in seen:
+            return c
+    if first is None:
+        print(f"⚠️ No usable app_port in the LLM reply; defaulting to {default}.")
+        return default
+    return first
+
+def _read_sse_content(lines) -> str:
+    """
+    Join `delta.content` from the decoded lines of a streamed (SSE) chat completion.
+    Returns as soon as the text forms a complete JSON object, without waiting for the stream to end.
+    A running brace depth (string/escape aware) spots the object's end, so the text is only joined
+    and decoded once instead of at every '}' (startup scripts are full of ${...}).
+    """
+    parts = []
+    depth, in_str, esc = 0, False, False
+    for line in lines:
+        if not line or not line.startswith("data:"):
+            continue  # keep-alives / SSE comments
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        choices = _json_loads(data).get("choices") or []
+        delta = (choices[0].get("delta") or {}).get("content") if choices else None
+        if not delta:
+            continue
+        parts.append(delta)
+        for ch in delta:
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == "\\":
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            elif ch == '"' and depth:
+                in_str = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}" and depth:
+                depth -= 1
+                if depth == 0:
+                    text = _strip_json_fence("".join(parts))
+                    try:
+                        _JSON_DECODER.raw_decode(text, text.find("{"))
+                        return text
+                    except ValueError:
+                        pass
+    return "".join(parts)
+
+def _post_chat(url, headers, payload, timeout, stream) -> str:
+    """POST a chat completion over the HTTP/2 client when available, else the requests session."""
+    http = _http2_client()
+    if http is not None:
+        if stream:
+            with http.stream("POST", url, headers=headers, json=payload, timeout=timeout) as r:
+                if r.is_error:
+                    r.read()  # load the body so the error report can show it
+                r.raise_for_status()
+                return _read_sse_content(r.iter_lines())
+        r = http.post(url, headers=headers, json=payload, timeout=timeout)
+        r.raise_for_status()
+        return _json_loads(r.content)["choices"][0]["message"]["content"]
+
+    r = _SESSION.post(url, headers=headers, json=payload, timeout=timeout, stream=stream)
+    r.raise_for_status()
+    if stream:
+        with r:
+            r.encoding = "utf-8"
+            return _read_sse_content(r.iter_lines(decode_unicode=True))
+    return _json_loads(r.content)["choices"][0]["message"]["content"]
+
+_JSON_MODE = {"type": "json_object"}
+
+def chat_complete(messages, model=None, provider=None, timeout=60, stream=False,
+                  max_tokens=None, response_format=None):
     """
     provider: "openai" or "openrouter" (auto-detect by env if None)
+    stream: request an SSE stream and return once a complete JSON object has arrived
+    max_tokens: cap on generated tokens, so short answers stop server-side instead of trailing prose
+    response_format: e.g. _JSON_MODE to have the model emit a bare JSON object
     Env:
       - OPENAI_API_KEY      (for provider=openai)
       - OPENROUTER_API_KEY  (for provider=openrouter)
       - AI_MODEL            (optional override)
       - AI_PROVIDER         (optional: "openai"|"openrouter")
+      - AUTODEPLOY_LLM_CACHE (optional: "1" reuses replies to identical prompts from ~/.cache/autodeploy/llm)
     """
     prov = (provider or os.getenv("AI_PROVIDER") or "").strip().lower()
     if prov not in ("openai", "openrouter"):
@@ -63,96 +289,205 @@ def chat_complete(messages, model=None, provider=None, timeout=60):
         headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
         payload = {"model": model, "messages": messages, "temperature": 0}
 
+    if max_tokens is not None:
+        payload["max_tokens"] = max_tokens
+    if response_format is not None:
+        payload["response_format"] = response_format
+
+    # Content-addressed reply cache (temperature is 0, so identical prompts give reusable answers)
+    cache_path = None
+    if os.getenv("AUTODEPLOY_LLM_CACHE") == "1":
+        key = hashlib.blake2b(
+            (prov + model + json.dumps([messages, max_tokens, response_format], sort_keys=True)).encode("utf-8"),
+            digest_size=16,
+        ).hexdigest()
+        cache_path = CACHE_DIR / "llm" / key
+        try:
+            return cache_path.read_text(encoding="utf-8")
+        except OSError:
+            pass
+
+    if stream:
+        payload["stream"] = True
+
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=timeout)
-        r.raise_for_status()
-        return r.json()["choices"][0]["message"]["content"]
-    except requests.exceptions.HTTPError as err:
-        print(f"HTTP error occurred: {err.response.status_code} - {err.response.text}", file=sys.stderr)
-        raise
+        content = _post_chat(url, headers, payload, timeout, stream)
     except Exception as err:
-        print(f"An unexpected error occurred: {err}", file=sys.stderr)
+        # requests.HTTPError and httpx.HTTPStatusError both carry the failed response
+        response = getattr(err, "response", None)
+        if response is not None:
+            print(f"HTTP error occurred: {response.status_code} - {response.text}", file=sys.stderr)
+        else:
+            print(f"An unexpected error occurred: {err}", file=sys.stderr)
         raise
 
+    if cache_path and content:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(content, encoding="utf-8")
+        except OSError:
+            pass  # cache is best-effort
+    return content
+
 # ---------------- Generic helpers ----------------
+def compact_json(obj) -> str:
+    """Minified JSON for LLM payloads (each padding space is a billed prompt token) and tfvars files."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
 def safe_input(prompt: str, default: str | None = None) -> str:
     s = input(f"{prompt}{' ['+default+']' if default else ''}: ").strip()
     return s or (default or "")
 
-def repo_name_from_url(repo_url: str) -> str:
-    name = urlparse(repo_url).path.rstrip("/").split("/")[-1]
-    return name[:-4] if name.endswith(".git") else name
+@functools.lru_cache(maxsize=128)
+def parse_github_url(repo_url: str) -> tuple[str, str, str | None]:
+    """
+    ('owner', 'repo', ref-or-None) from an https, scheme-less or git@ GitHub URL, optionally ending
+    in .git or /tree/<ref>, with any query/fragment dropped, in one regex match.
+    Raises ValueError for anything else.
+    """
+    m = _GH_URL_RE.match(repo_url.strip())
+    if not m:
+        raise ValueError(f"Not a GitHub repository URL: {repo_url!r}")
+    return m["owner"], m["repo"], m["ref"]
+
+
+# GitHub token -> epoch second its rate limit resets; tokens are skipped until then
+_GH_TOKEN_RESET: dict[str, float] = {}
+_GH_TOKEN_TURN = itertools.count()
+
+
+def github_get(url: str, headers: dict):
+    """
+    GET a GitHub API URL through _SESSION, round-robining over GITHUB_TOKENS (comma-separated;
+    GITHUB_PAT also accepted). A token that answers with an exhausted rate limit is parked until
+    its X-RateLimit-Reset and the request moves on to the next one; with no tokens it goes anonymous.
+    """
+    raw = os.getenv("GITHUB_TOKENS") or os.getenv("GITHUB_PAT") or ""
+    tokens = [t.strip() for t in raw.split(",") if t.strip()]
+    if tokens:
+        turn = next(_GH_TOKEN_TURN) % len(tokens)
+        tokens = tokens[turn:] + tokens[:turn]
+    now = time.time()
+    usable = [t for t in tokens if _GH_TOKEN_RESET.get(t, 0) <= now] or [None]
+
+    for token in usable:
+        h = dict(headers, Authorization=f"token {token}") if token else headers
+        response = _SESSION.get(url, headers=h)
+        if (token and response.status_code in (403, 429)
+                and response.headers.get("X-RateLimit-Remaining") == "0"):
+            _GH_TOKEN_RESET[token] = float(response.headers.get("X-RateLimit-Reset") or now + 60)
+            continue
+        return response
+    return response
 
 
 def get_repo_tree(owner, repo, branch="main"):
-    api_url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
-    headers = {"Accept": "application/vnd.github.v3+json", "User-Agent": "AutoDeploy Chat System"}
-    github_pat = os.getenv('GITHUB_PAT')
-    if github_pat:
-        headers["Authorization"] = f"token {github_pat}"
+    """
+    List blob paths in the repo tree. The last response is cached on disk with its ETag and
+    revalidated via If-None-Match; a 304 reuses the cached paths (no body, no rate-limit cost).
+    Successful results are also memoized in-process.
+    """
     try:
-        response = requests.get(api_url, headers=headers)
-        response.raise_for_status()
-        tree = response.json().get('tree', [])
-        return [item['path'] for item in tree if item['type'] == 'blob']
+        return list(_fetch_repo_tree(owner, repo, branch))
     except requests.exceptions.RequestException as e:
         print(f"Error accessing repo tree: {e}")
         return None
 
-def write_file(path: Path, content: str):
-    path.write_text(content.rstrip() + "\n")
-
-# --- Terraform and Startup Script Generation ---
-def create_startup_sh(repo_url: str, app_port: int, entrypoint: str, dependencies: str) -> str:
-    return f"""#!/usr/bin/env bash
-set -euxo pipefail
-
-# ---- logging ----
-LOG_DIR=/var/log/autodeploy
-LOG_FILE="$LOG_DIR/startup.log"
-mkdir -p "$LOG_DIR"
-touch "$LOG_FILE"
-chmod 0644 "$LOG_FILE"
-# send all stdout/stderr to the log file
-exec >>"$LOG_FILE" 2>&1
 
-echo "=== $(date -Is) startup.sh BEGIN ==="
+@functools.lru_cache(maxsize=16)
+def _fetch_repo_tree(owner, repo, branch) -> tuple[str, ...]:
+    """Uncached-in-memory fetch behind get_repo_tree; raises RequestException so failures are not memoized."""
+    api_url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
+    headers = {"Accept": "application/vnd.github.v3+json", "User-Agent": "AutoDeploy Chat System"}
 
-REPO_URL="{repo_url}"
-REPO_DIR="/opt/app"
+    cache_path = CACHE_DIR / f"tree-{owner}-{repo}-{branch.replace('/', '%2F')}.json"  # refs may hold '/'
+    cached = None
+    try:
+        cached = _json_loads(cache_path.read_bytes())
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+    except (OSError, ValueError):
+        cached = None
+
+    response = github_get(api_url, headers)
+    if response.status_code == 304 and cached:
+        return tuple(cached["paths"])
+    response.raise_for_status()
+    tree = _json_loads(response.content).get('tree', [])
+    paths = tuple(item['path'] for item in tree if item['type'] == 'blob')
+
+    etag = response.headers.get("ETag")
+    if etag:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(compact_json({"etag": etag, "paths": list(paths)}))
+        except OSError:
+            pass  # cache is best-effort
+    return paths
+
+@functools.lru_cache(maxsize=1)
+def _default_ssh_pub() -> str | None:
+    """First existing ~/.ssh/id_ed25519.pub or ~/.ssh/id_rsa.pub, read once per run."""
+    for p in [Path.home()/".ssh/id_ed25519.pub", Path.home()/".ssh/id_rsa.pub"]:
+        try:
+            return p.read_text().strip()
+        except OSError:
+            continue
+    return None
 
-# ---- packages ----
-export DEBIAN_FRONTEND=noninteractive
-apt-get update -y
-apt-get install -y git python3 python3-pip
+def discover_ssh_pub(env_var: str) -> str:
+    """SSH public key from `env_var`, else the cached default key; raises RuntimeError if neither exists."""
+    ssh_pub = os.getenv(env_var) or _default_ssh_pub()
+    if not ssh_pub:
+        raise RuntimeError(f"Provide an SSH public key via {env_var} or at ~/.ssh/id_ed25519.pub / ~/.ssh/id_rsa.pub")
+    return ssh_pub
 
-# ---- app setup ----
-mkdir -p "$REPO_DIR"
-if [ ! -d "$REPO_DIR/.git" ]; then
-  git clone --depth 1 "$REPO_URL" "$REPO_DIR"
-else
-  git -C "$REPO_DIR" pull --ff-only || true
-fi
+def write_file(path: Path, content: str | bytes):
+    # Templates are pre-encoded and already end in exactly one newline; only normalize other content
+    if isinstance(content, bytes):
+        data = content
+    else:
+        data = (content if content.endswith("\n") else content.rstrip() + "\n").encode("utf-8")
+    try:
+        if path.read_bytes() == data:
+            return  # unchanged; also avoids truncating a file a background `terraform init` may be reading
+    except OSError:
+        pass
+    path.write_bytes(data)
 
-cd "$REPO_DIR"
-if [ -f "{dependencies}" ]; then
-  pip3 install -r {dependencies}
-fi
 
-# ---- run app ----
-nohup python3 {entrypoint} >/dev/null 2>&1 &
-echo "=== $(date -Is) startup.sh END ==="
-"""
+def write_files(files: dict[Path, str | bytes]):
+    """write_file for several files at once; the writes overlap in a small thread pool."""
+    with ThreadPoolExecutor(max_workers=max(1, len(files))) as ex:
+        list(ex.map(lambda item: write_file(*item), files.items()))
 
 
-def write_terraform_files(provider: str, app_port: int, repo_name: str, output_dir: Path, project_id: str=None):
+def run_with_heartbeat(cmd, interval: int = 30, label: str | None = None, **kwargs):
     """
-    provider: "GCP" or "Azure"
-      - For GCP: project_id = GCP project ID
-      - For Azure: ignores project_id; reads AZURE_* env vars instead
+    subprocess.run(cmd, **kwargs), printing a progress line every `interval` seconds
+    from a daemon thread until the command exits (long `terraform apply` runs are otherwise silent).
     """
-    if provider == "GCP":
-        main_tf = """
+    label = label or " ".join(cmd[:2])
+    stop = threading.Event()
+
+    def _beat():
+        elapsed = 0
+        while not stop.wait(interval):
+            elapsed += interval
+            print(f"⏳ {label} still running... ({elapsed}s)", flush=True)
+
+    t = threading.Thread(target=_beat, daemon=True)
+    t.start()
+    try:
+        return subprocess.run(cmd, **kwargs)
+    finally:
+        stop.set()
+        t.join()
+
+# --- Terraform templates (static; built and UTF-8 encoded once at import) ---
+_GCP_MAIN_TF = """
 terraform {
   required_providers {
     google = {
@@ -200,7 +535,9 @@ resource "google_compute_instance" "app_vm" {
 
   boot_disk {
     initialize_params {
-      image = "ubuntu-os-cloud/ubuntu-2204-lts"
+      image = var.image
+      size  = var.disk_size_gb
+      type  = var.disk_type
     }
   }
 
@@ -216,9 +553,9 @@ resource "google_compute_instance" "app_vm" {
 output "public_ip" {
   value = google_compute_instance.app_vm.network_interface[0].access_config[0].nat_ip
 }
-""".lstrip()
+""".lstrip().encode()
 
-        variables_tf = """
+_GCP_VARIABLES_TF = """
 variable "project" {
   description = "GCP project ID"
   type        = string
@@ -242,88 +579,70 @@ variable "vm_size" {
   default     = "e2-small"
 }
 
-variable "app_port" {
-  description = "Application port"
-  type        = number
+variable "image" {
+  description = "Boot image or image family (e.g. a pre-baked image with runtimes installed)"
+  type        = string
+  default     = "ubuntu-os-cloud/ubuntu-2204-lts"
 }
-""".lstrip()
 
-        tfvars_data = {"app_port": app_port, "project": project_id, "zone": "us-central1-a"}
-
-        write_file(output_dir / "main.tf", main_tf)
-        write_file(output_dir / "variables.tf", variables_tf)
-        write_file(output_dir / "terraform.tfvars.json", json.dumps(tfvars_data, indent=2))
-        print(f"✅ Terraform files generated for {provider}.")
+variable "disk_size_gb" {
+  description = "Boot disk size in GB"
+  type        = number
+  default     = 10
+}
 
-    elif provider == "Azure":
-        # Gather config from env (with sane defaults)
-        subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
-        if not subscription_id:
-            # best-effort auto-detect via CLI
-            try:
-                res = subprocess.run(
-                    ["az", "account", "show", "--query", "id", "-o", "tsv"],
-                    check=True, capture_output=True, text=True
-                )
-                subscription_id = res.stdout.strip()
-            except Exception:
-                raise RuntimeError("AZURE_SUBSCRIPTION_ID is not set and could not auto-detect via `az account show`.")
+variable "disk_type" {
+  description = "Boot disk type; pd-ssd gives the apt/pip-heavy startup script more IOPS"
+  type        = string
+  default     = "pd-ssd"
+}
 
-        location       = os.getenv("AZURE_LOCATION", "eastus")
-        rg_name        = os.getenv("AZURE_RG_NAME", "autodeploy-rg")
-        vm_size        = os.getenv("AZURE_VM_SIZE", "Standard_B2s")
-        admin_username = os.getenv("AZURE_ADMIN_USERNAME", "azureuser")
+variable "app_port" {
+  description = "Application port"
+  type        = number
+}
+""".lstrip().encode()
 
-        ssh_pub = os.getenv("AZURE_SSH_PUBLIC_KEY")
-        if not ssh_pub:
-            # Try common keys
-            for p in [Path.home()/".ssh/id_ed25519.pub", Path.home()/".ssh/id_rsa.pub"]:
-                if p.exists():
-                    ssh_pub = p.read_text().strip()
-                    break
-        if not ssh_pub:
-            raise RuntimeError("Provide an SSH public key via AZURE_SSH_PUBLIC_KEY or at ~/.ssh/id_ed25519.pub / ~/.ssh/id_rsa.pub")
-
-        main_tf = f"""
-terraform {{
-  required_providers {{
-    azurerm = {{
+_AZURE_MAIN_TF = """
+terraform {
+  required_providers {
+    azurerm = {
       source  = "hashicorp/azurerm"
       version = ">= 3.100.0"
-    }}
-  }}
-}}
+    }
+  }
+}
 
-provider "azurerm" {{
-  features {{}}
+provider "azurerm" {
+  features {}
   subscription_id = var.subscription_id
-}}
+}
 
-resource "azurerm_resource_group" "rg" {{
+resource "azurerm_resource_group" "rg" {
   name     = var.rg_name
   location = var.location
-}}
+}
 
-resource "azurerm_virtual_network" "vnet" {{
+resource "azurerm_virtual_network" "vnet" {
   name                = "autodeploy-vnet"
   location            = azurerm_resource_group.rg.location
   resource_group_name = azurerm_resource_group.rg.name
   address_space       = ["10.0.0.0/16"]
-}}
+}
 
-resource "azurerm_subnet" "subnet" {{
+resource "azurerm_subnet" "subnet" {
   name                 = "autodeploy-subnet"
   resource_group_name  = azurerm_resource_group.rg.name
   virtual_network_name = azurerm_virtual_network.vnet.name
   address_prefixes     = ["10.0.1.0/24"]
-}}
+}
 
-resource "azurerm_network_security_group" "nsg" {{
+resource "azurerm_network_security_group" "nsg" {
   name                = "autodeploy-nsg"
   location            = azurerm_resource_group.rg.location
   resource_group_name = azurerm_resource_group.rg.name
 
-  security_rule {{
+  security_rule {
     name                       = "allow-ssh"
     priority                   = 1000
     direction                  = "Inbound"
@@ -333,9 +652,9 @@ resource "azurerm_network_security_group" "nsg" {{
     destination_port_range     = "22"
     source_address_prefix      = "*"
     destination_address_prefix = "*"
-  }}
+  }
 
-  security_rule {{
+  security_rule {
     name                       = "allow-http"
     priority                   = 1001
     direction                  = "Inbound"
@@ -345,9 +664,9 @@ resource "azurerm_network_security_group" "nsg" {{
     destination_port_range     = "80"
     source_address_prefix      = "*"
     destination_address_prefix = "*"
-  }}
+  }
 
-  security_rule {{
+  security_rule {
     name                       = "allow-app"
     priority                   = 1002
     direction                  = "Inbound"
@@ -357,36 +676,36 @@ resource "azurerm_network_security_group" "nsg" {{
     destination_port_range     = tostring(var.app_port)
     source_address_prefix      = "*"
     destination_address_prefix = "*"
-  }}
-}}
+  }
+}
 
-resource "azurerm_public_ip" "app_pip" {{
+resource "azurerm_public_ip" "app_pip" {
   name                = "autodeploy-pip"
   location            = azurerm_resource_group.rg.location
   resource_group_name = azurerm_resource_group.rg.name
   allocation_method   = "Static"
   sku                 = "Standard"
-}}
+}
 
-resource "azurerm_network_interface" "nic" {{
+resource "azurerm_network_interface" "nic" {
   name                = "autodeploy-nic"
   location            = azurerm_resource_group.rg.location
   resource_group_name = azurerm_resource_group.rg.name
 
-  ip_configuration {{
+  ip_configuration {
     name                          = "internal"
     subnet_id                     = azurerm_subnet.subnet.id
     private_ip_address_allocation = "Dynamic"
     public_ip_address_id          = azurerm_public_ip.app_pip.id
-  }}
-}}
+  }
+}
 
-resource "azurerm_network_interface_security_group_association" "nic_nsg" {{
+resource "azurerm_network_interface_security_group_association" "nic_nsg" {
   network_interface_id      = azurerm_network_interface.nic.id
   network_security_group_id = azurerm_network_security_group.nsg.id
-}}
+}
 
-resource "azurerm_linux_virtual_machine" "app_vm" {{
+resource "azurerm_linux_virtual_machine" "app_vm" {
   name                = "autodeploy-vm"
   location            = azurerm_resource_group.rg.location
   resource_group_name = azurerm_resource_group.rg.name
@@ -397,35 +716,35 @@ resource "azurerm_linux_virtual_machine" "app_vm" {{
     azurerm_network_interface.nic.id
   ]
 
-  os_disk {{
+  os_disk {
     caching              = "ReadWrite"
     storage_account_type = "Standard_LRS"
-  }}
+  }
 
   # Ubuntu 22.04 LTS Gen2
-  source_image_reference {{
+  source_image_reference {
     publisher = "Canonical"
     offer     = "0001-com-ubuntu-server-jammy"
     sku       = "22_04-lts-gen2"
     version   = "latest"
-  }}
+  }
 
   disable_password_authentication = true
-  admin_ssh_key {{
+  admin_ssh_key {
     username   = var.admin_username
     public_key = var.ssh_public_key
-  }}
+  }
 
   # Inject our startup.sh (cloud-init)
   custom_data = filebase64("startup.sh")
-}}
+}
 
-output "public_ip" {{
+output "public_ip" {
   value = azurerm_public_ip.app_pip.ip_address
-}}
-""".lstrip()
+}
+""".lstrip().encode()
 
-        variables_tf = """
+_AZURE_VARIABLES_TF = """
 variable "subscription_id" {
   description = "Azure Subscription ID"
   type        = string
@@ -464,49 +783,9 @@ variable "app_port" {
   description = "Application port"
   type        = number
 }
-""".lstrip()
-
-        tfvars_data = {
-            "subscription_id": subscription_id,
-            "location":        location,
-            "rg_name":         rg_name,
-            "vm_size":         vm_size,
-            "admin_username":  admin_username,
-            "ssh_public_key":  ssh_pub,
-            "app_port":        app_port,
-        }
-
-        write_file(output_dir / "main.tf", main_tf)
-        write_file(output_dir / "variables.tf", variables_tf)
-        write_file(output_dir / "terraform.tfvars.json", json.dumps(tfvars_data, indent=2))
-        print(f"✅ Terraform files generated for {provider}.")
-
-    else:
-        print(f"❌ Terraform file generation for {provider} not implemented.")
-
-def write_terraform_files_aws(app_port: int, repo_name: str, output_dir: Path):
-    """
-    Writes Terraform for AWS (EC2 in default VPC, SG opening 22/80/app_port),
-    key pair from provided SSH public key, Ubuntu 22.04, user_data=startup.sh.
-
-    Reads:
-      - AWS_REGION (default us-east-1)
-      - AWS_INSTANCE_TYPE (default t3.small)  # typically set by LLM in main()
-      - AWS_SSH_PUBLIC_KEY (falls back to ~/.ssh/id_ed25519.pub or id_rsa.pub)
-    """
-    region        = os.getenv("AWS_REGION", "us-east-1")
-    instance_type = os.getenv("AWS_INSTANCE_TYPE", "t3.small")
-
-    ssh_pub = os.getenv("AWS_SSH_PUBLIC_KEY")
-    if not ssh_pub:
-        for p in [Path.home()/".ssh/id_ed25519.pub", Path.home()/".ssh/id_rsa.pub"]:
-            if p.exists():
-                ssh_pub = p.read_text().strip()
-                break
-    if not ssh_pub:
-        raise RuntimeError("Provide an SSH public key via AWS_SSH_PUBLIC_KEY or at ~/.ssh/id_ed25519.pub / ~/.ssh/id_rsa.pub")
+""".lstrip().encode()
 
-    main_tf = """
+_AWS_MAIN_TF = """
 terraform {
   required_providers {
     aws = {
@@ -664,9 +943,9 @@ resource "aws_instance" "app" {
 output "public_ip" {
   value = aws_instance.app.public_ip
 }
-""".lstrip()
+""".lstrip().encode()
 
-    variables_tf = """
+_AWS_VARIABLES_TF = """
 variable "region" {
   description = "AWS region"
   type        = string
@@ -688,118 +967,546 @@ variable "app_port" {
   description = "Application port"
   type        = number
 }
-""".lstrip()
+""".lstrip().encode()
 
-    tfvars_data = {
-        "region":         region,
-        "instance_type":  instance_type,
-        "ssh_public_key": ssh_pub,
-        "app_port":       app_port,
-    }
+# --- Terraform and Startup Script Generation ---
+def create_startup_sh(repo_url: str, app_port: int, entrypoint: str, dependencies: str) -> str:
+    return f"""#!/usr/bin/env bash
+set -euxo pipefail
 
-    write_file(output_dir / "main.tf", main_tf)
-    write_file(output_dir / "variables.tf", variables_tf)
-    write_file(output_dir / "terraform.tfvars.json", json.dumps(tfvars_data, indent=2))
-    print("✅ Terraform files generated for AWS (AZ-aware subnet + arch-aware AMI, no regex escapes).")
+# ---- logging ----
+LOG_DIR=/var/log/autodeploy
+LOG_FILE="$LOG_DIR/startup.log"
+mkdir -p "$LOG_DIR"
+touch "$LOG_FILE"
+chmod 0644 "$LOG_FILE"
+# send all stdout/stderr to the log file
+exec >>"$LOG_FILE" 2>&1
+
+echo "=== $(date -Is) startup.sh BEGIN ==="
+
+REPO_URL="{repo_url}"
+REPO_DIR="/opt/app"
 
+# ---- packages ----
+export DEBIAN_FRONTEND=noninteractive
+apt-get update -y
+apt-get install -y git python3 python3-pip
 
+# ---- app setup ----
+mkdir -p "$REPO_DIR"
+if [ ! -d "$REPO_DIR/.git" ]; then
+  git clone --depth 1 "$REPO_URL" "$REPO_DIR"
+else
+  git -C "$REPO_DIR" pull --ff-only || true
+fi
 
+cd "$REPO_DIR"
+if [ -f "{dependencies}" ]; then
+  pip3 install -r {dependencies}
+fi
 
+# ---- run app ----
+nohup python3 {entrypoint} >/dev/null 2>&1 &
+echo "=== $(date -Is) startup.sh END ==="
+"""
 
 
-def pick_random_existing_project(billing_account_id: str | None) -> str | None:
+def write_terraform_files(provider: str, app_port: int, repo_name: str, output_dir: Path, project_id: str=None,
+                          sources_only: bool = False):
     """
-    Returns a usable existing projectId at random, or None if none work.
-    A project is considered usable if:
-      - we can `gcloud config set project <id>`
-      - billing is linked (we try to link; it's fine if already linked)
-      - Compute Engine API can be enabled
+    provider: "GCP" or "Azure"
+      - For GCP: project_id = GCP project ID
+      - For Azure: ignores project_id; reads AZURE_* env vars instead
+    sources_only: write just main.tf/variables.tf (enough for `terraform init`), skip tfvars
     """
-    # Get active projects the caller can see
-    lst = subprocess.run(
-        ["gcloud", "projects", "list", "--filter=lifecycleState=ACTIVE", "--format=value(projectId)"],
-        check=False, capture_output=True, text=True
-    )
-    projects = [p.strip() for p in (lst.stdout or "").splitlines() if p.strip()]
-    if not projects:
-        return None
+    if provider == "GCP":
+        write_files({output_dir / "main.tf": _GCP_MAIN_TF, output_dir / "variables.tf": _GCP_VARIABLES_TF})
+        seed_terraform_lock(provider, output_dir)
+        if sources_only:
+            return
 
-    random.shuffle(projects)
+        tfvars_data = {"app_port": app_port, "project": project_id, "zone": "us-central1-a"}
+        if os.getenv("GCP_IMAGE"):
+            tfvars_data["image"] = os.getenv("GCP_IMAGE")
+        write_file(output_dir / "terraform.tfvars.json", compact_json(tfvars_data))
+        print(f"✅ Terraform files generated for {provider}.")
 
-    for pid in projects:
-        try:
-            # Point gcloud at the candidate
-            subprocess.run(["gcloud", "config", "set", "project", pid], check=True, capture_output=True, text=True)
-
-            # Try to link billing (ignore failure if already linked or permission-limited)
-            if billing_account_id:
-                subprocess.run(
-                    ["gcloud", "billing", "projects", "link", pid, "--billing-account", billing_account_id],
-                    check=False, capture_output=True, text=True
-                )
+    elif provider == "Azure":
+        write_files({output_dir / "main.tf": _AZURE_MAIN_TF, output_dir / "variables.tf": _AZURE_VARIABLES_TF})
+        seed_terraform_lock(provider, output_dir)
+        if sources_only:
+            return
 
-            # Ensure Compute Engine API is on
-            subprocess.run(["gcloud", "services", "enable", "compute.googleapis.com"],
-                           check=True, capture_output=True, text=True)
+        # Gather config from env (with sane defaults)
+        subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+        if not subscription_id:
+            # best-effort auto-detect via CLI
+            try:
+                res = subprocess.run(
+                    ["az", "account", "show", "--query", "id", "-o", "tsv"],
+                    check=True, capture_output=True, text=True
+                )
+                subscription_id = res.stdout.strip()
+            except Exception:
+                raise RuntimeError("AZURE_SUBSCRIPTION_ID is not set and could not auto-detect via `az account show`.")
+
+        location       = os.getenv("AZURE_LOCATION", "eastus")
+        rg_name        = os.getenv("AZURE_RG_NAME", "autodeploy-rg")
+        vm_size        = os.getenv("AZURE_VM_SIZE", "Standard_B2s")
+        admin_username = os.getenv("AZURE_ADMIN_USERNAME", "azureuser")
+
+        ssh_pub = discover_ssh_pub("AZURE_SSH_PUBLIC_KEY")
+
+        tfvars_data = {
+            "subscription_id": subscription_id,
+            "location":        location,
+            "rg_name":         rg_name,
+            "vm_size":         vm_size,
+            "admin_username":  admin_username,
+            "ssh_public_key":  ssh_pub,
+            "app_port":        app_port,
+        }
+
+        write_file(output_dir / "terraform.tfvars.json", compact_json(tfvars_data))
+        print(f"✅ Terraform files generated for {provider}.")
+
+    else:
+        print(f"❌ Terraform file generation for {provider} not implemented.")
+
+def write_terraform_files_aws(app_port: int, repo_name: str, output_dir: Path, sources_only: bool = False,
+                              instance_type: str | None = None):
+    """
+    Writes Terraform for AWS (EC2 in default VPC, SG opening 22/80/app_port),
+    key pair from provided SSH public key, Ubuntu 22.04, user_data=startup.sh.
+
+    Reads:
+      - AWS_REGION (default us-east-1)
+      - AWS_INSTANCE_TYPE (default t3.small), unless instance_type is given
+      - AWS_SSH_PUBLIC_KEY (falls back to ~/.ssh/id_ed25519.pub or id_rsa.pub)
+
+    sources_only: write just main.tf/variables.tf (all `terraform init` needs) and skip tfvars.
+    instance_type: overrides AWS_INSTANCE_TYPE; deploy_on_aws passes its pick here, not via os.environ.
+    """
+    write_files({output_dir / "main.tf": _AWS_MAIN_TF, output_dir / "variables.tf": _AWS_VARIABLES_TF})
+    seed_terraform_lock("AWS", output_dir)
+    if sources_only:
+        return
+
+    region        = os.getenv("AWS_REGION", "us-east-1")
+    instance_type = instance_type or os.getenv("AWS_INSTANCE_TYPE", "t3.small")
+
+    ssh_pub = discover_ssh_pub("AWS_SSH_PUBLIC_KEY")
+
+    tfvars_data = {
+        "region":         region,
+        "instance_type":  instance_type,
+        "ssh_public_key": ssh_pub,
+        "app_port":       app_port,
+    }
+
+    write_file(output_dir / "terraform.tfvars.json", compact_json(tfvars_data))
+    print("✅ Terraform files generated for AWS (AZ-aware subnet + arch-aware AMI, no regex escapes).")
+
+
+
+
+
+
+def terraform_env() -> dict:
+    """os.environ plus a persistent TF_PLUGIN_CACHE_DIR so provider binaries are reused across runs."""
+    tf_env = os.environ.copy()
+    tf_env.setdefault("TF_PLUGIN_CACHE_DIR", os.path.expanduser("~/.terraform.d/plugin-cache"))
+    # Fresh output dirs have no lock file yet; let init link from the cache instead of re-downloading
+    tf_env.setdefault("TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE", "true")
+    os.makedirs(tf_env["TF_PLUGIN_CACHE_DIR"], exist_ok=True)
+    return tf_env
+
+
+def _terraform_lock_cache(provider: str) -> Path:
+    return CACHE_DIR / "locks" / f"{provider.lower()}.terraform.lock.hcl"
+
+
+def seed_terraform_lock(provider: str, output_dir: Path):
+    """
+    Copy the last known-good provider lock into an output_dir that has none, so init installs
+    exactly those versions (straight from the plugin cache) instead of resolving them again.
+    """
+    lock, cached = output_dir / ".terraform.lock.hcl", _terraform_lock_cache(provider)
+    if not lock.exists() and cached.exists():
+        try:
+            shutil.copyfile(cached, lock)
+        except OSError:
+            pass
+
+
+def save_terraform_lock(provider: str, output_dir: Path):
+    """After a successful init, keep output_dir's lock file as the seed for future fresh dirs."""
+    try:
+        cached = _terraform_lock_cache(provider)
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(output_dir / ".terraform.lock.hcl", cached)
+    except OSError:
+        pass
+
+
+def start_terraform_init(provider: str, output_dir: Path) -> subprocess.Popen | None:
+    """
+    Write the provider's .tf sources and launch `terraform init -reconfigure` in the background.
+    Init needs neither tfvars nor startup.sh, so it can overlap LLM calls and project setup.
+    Returns None if terraform could not be started (callers then init synchronously).
+    Output goes to .terraform-init.log in output_dir (tail -f it to follow progress), so a
+    chatty init can never stall on a full pipe nobody is reading yet.
+    """
+    if provider == "AWS":
+        clean_non_aws_leftovers(output_dir)
+        write_terraform_files_aws(None, "", output_dir, sources_only=True)
+    else:
+        write_terraform_files(provider, None, "", output_dir, sources_only=True)
+    print(f"$ {' '.join(TF_INIT_CMD)}  (background, log: {output_dir / '.terraform-init.log'})")
+    try:
+        with open(output_dir / ".terraform-init.log", "w") as log:
+            return subprocess.Popen(
+                TF_INIT_CMD, cwd=output_dir, stdout=log, stderr=subprocess.STDOUT, env=terraform_env()
+            )
+    except OSError:
+        return None
 
-            return pid  # success
+
+def finish_terraform_init(proc: subprocess.Popen, output_dir: Path):
+    """
+    Wait for a background init, then replay its log line by line.
+    Raises CalledProcessError on failure, carrying only the last lines of output.
+    """
+    proc.wait()
+    tail = deque(maxlen=50)
+    with open(output_dir / ".terraform-init.log", errors="replace") as log:
+        for line in log:
+            print(line, end="")
+            tail.append(line)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, output="".join(tail))
+
+
+def terraform_plan_and_apply(output_dir: Path, tf_env: dict):
+    """
+    Plan into plan.bin, then apply that saved plan so apply does not re-plan.
+    A first deploy has no state to refresh, so its plan skips refresh entirely.
+    Heartbeats name output_dir so concurrent multi-cloud applies can be told apart.
+    """
+    plan_cmd = ["terraform", "plan", "-out=plan.bin", "-input=false", f"-parallelism={TF_PARALLELISM}",
+                "-lock-timeout=5m"]
+    if not (output_dir / "terraform.tfstate").exists():
+        plan_cmd.append("-refresh=false")
+    print(f"$ {' '.join(plan_cmd)}")
+    run_with_heartbeat(plan_cmd, label=f"terraform plan in {output_dir}", cwd=output_dir, check=True, env=tf_env)
+    print(f"$ {' '.join(TF_APPLY_CMD)} plan.bin")
+    run_with_heartbeat(TF_APPLY_CMD + ["plan.bin"], label=f"terraform apply in {output_dir}", cwd=output_dir,
+                       check=True, env=tf_env)
+
+
+def terraform_public_ip(output_dir: Path, tf_env: dict) -> str:
+    """
+    Read the public_ip output straight from the local state apply just wrote,
+    falling back to `terraform output` (e.g. for a remote backend).
+    """
+    try:
+        state = _json_loads((output_dir / "terraform.tfstate").read_bytes())
+        return state["outputs"]["public_ip"]["value"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    result = subprocess.run(
+        ["terraform", "output", "-json", "public_ip"],
+        cwd=output_dir, check=True, capture_output=True, text=True, env=tf_env
+    )
+    try:
+        parsed = json.loads(result.stdout)
+        return parsed.get("value", parsed) if isinstance(parsed, dict) else parsed
+    except ValueError:
+        return result.stdout.strip().strip('"')
+
+
+def enabled_gcp_services(project_id: str | None = None) -> set[str]:
+    """Return the set of APIs already enabled on project_id (or the active gcloud project); empty on failure."""
+    cmd = ["gcloud", "services", "list", "--enabled", "--format=value(config.name)"]
+    if project_id:
+        cmd.append(f"--project={project_id}")
+    res = subprocess.run(cmd, check=False, capture_output=True, text=True)
+    if res.returncode != 0:
+        return set()
+    return {s.strip() for s in (res.stdout or "").splitlines() if s.strip()}
+
+
+def enable_gcp_services(services: tuple[str, ...] = GCP_SERVICES_NEEDED, skip_enabled: bool = True,
+                        quiet: bool = False, project_id: str | None = None):
+    """
+    Enable all `services` with a single `gcloud services enable` call.
+    With skip_enabled, services already on are filtered out first (no call at all on warm projects).
+    project_id targets a specific project instead of the active gcloud config.
+    Raises subprocess.CalledProcessError if the enable call fails.
+    """
+    missing = list(services)
+    if skip_enabled:
+        already = enabled_gcp_services(project_id)
+        missing = [s for s in missing if s not in already]
+    if not missing:
+        return
+    cmd = ["gcloud", "services", "enable", *missing]
+    if project_id:
+        cmd.append(f"--project={project_id}")
+    if not quiet:
+        print(f"$ {' '.join(cmd)}")
+    subprocess.run(cmd, check=True, capture_output=quiet, text=True)
+
+
+@functools.lru_cache(maxsize=1)
+def gcloud_access_token() -> str | None:
+    """Fetch one OAuth token from the gcloud login for direct REST calls (None if unavailable); cached per run."""
+    try:
+        res = subprocess.run(["gcloud", "auth", "print-access-token"], check=False, capture_output=True, text=True)
+    except OSError:
+        return None
+    token = (res.stdout or "").strip()
+    return token if res.returncode == 0 and token else None
+
+
+def list_active_projects(token: str | None = None) -> list[str]:
+    """ACTIVE project IDs visible to the caller; via REST when a token is given, else `gcloud projects list`."""
+    if token:
+        try:
+            ids, page_token = [], None
+            while True:
+                params = {"filter": "lifecycleState:ACTIVE", "pageSize": 500}
+                if page_token:
+                    params["pageToken"] = page_token
+                r = _SESSION.get(f"{_GCP_CRM_API}/projects", headers={"Authorization": f"Bearer {token}"},
+                                 params=params, timeout=30)
+                r.raise_for_status()
+                body = r.json()
+                ids += [p["projectId"] for p in body.get("projects", [])]
+                page_token = body.get("nextPageToken")
+                if not page_token:
+                    return ids
+        except requests.exceptions.RequestException:
+            pass  # fall back to gcloud
+
+    lst = subprocess.run(
+        ["gcloud", "projects", "list", "--filter=lifecycleState=ACTIVE", "--format=value(projectId)"],
+        check=False, capture_output=True, text=True
+    )
+    return [p.strip() for p in (lst.stdout or "").splitlines() if p.strip()]
+
+
+def _check_project_access(pid: str, token: str | None = None) -> str:
+    """
+    Read-only check that the caller can see pid (REST with a token, else `gcloud projects describe`).
+    Changes nothing, so many candidates can be probed concurrently. Returns pid or raises.
+    """
+    if token:
+        r = _SESSION.get(f"{_GCP_CRM_API}/projects/{pid}", headers={"Authorization": f"Bearer {token}"}, timeout=30)
+        r.raise_for_status()
+        return pid
+    subprocess.run(["gcloud", "projects", "describe", pid, "--format=value(projectId)"],
+                   check=True, capture_output=True, text=True)
+    return pid
+
+
+def _prepare_project_rest(pid: str, billing_account_id: str | None, token: str) -> str:
+    """REST equivalent of the gcloud preparation in _prepare_project (one HTTPS call per step, no CLI spawn)."""
+    headers = {"Authorization": f"Bearer {token}"}
+
+    # Link billing; a failed link is only tolerated if billing is already enabled some other way
+    if billing_account_id:
+        account = billing_account_id if billing_account_id.startswith("billingAccounts/") else f"billingAccounts/{billing_account_id}"
+        r = _SESSION.put(f"{_GCP_BILLING_API}/projects/{pid}/billingInfo", headers=headers,
+                         json={"billingAccountName": account}, timeout=30)
+        if not r.ok:
+            info = _SESSION.get(f"{_GCP_BILLING_API}/projects/{pid}/billingInfo", headers=headers, timeout=30)
+            if not (info.ok and info.json().get("billingEnabled")):
+                raise RuntimeError(f"Linking billing on {pid} failed: {r.status_code} {r.text[:200]}")
+
+    # Enable all required APIs in one call, then wait on the long-running operation like gcloud does
+    r = _SESSION.post(f"{_GCP_SERVICEUSAGE_API}/projects/{pid}/services:batchEnable", headers=headers,
+                      json={"serviceIds": list(GCP_SERVICES_NEEDED)}, timeout=60)
+    r.raise_for_status()
+    op = r.json()
+    if not op.get("done") and not op.get("name") and not op.get("error"):
+        raise RuntimeError(f"Enabling services on {pid} returned no operation: {r.text[:200]}")
+    deadline = time.monotonic() + 300
+    while not op.get("done") and not op.get("error"):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Timed out enabling services on {pid}")
+        time.sleep(2)
+        r = _SESSION.get(f"{_GCP_SERVICEUSAGE_API}/{op['name']}", headers=headers, timeout=30)
+        r.raise_for_status()
+        op = r.json()
+    if op.get("error"):
+        raise RuntimeError(f"Enabling services on {pid} failed: {op['error'].get('message')}")
+    return pid
+
+
+def _prepare_project(pid: str, billing_account_id: str | None, token: str | None = None) -> str:
+    """
+    Make an existing, accessible project deployable: link billing, enable APIs.
+    With an access token this goes straight to the REST APIs; otherwise it shells out to gcloud.
+    This mutates the project, so it is only run on the candidate actually chosen.
+    Returns pid on success; raises subprocess.CalledProcessError (or an HTTP/RuntimeError on the REST path).
+    """
+    if token:
+        return _prepare_project_rest(pid, billing_account_id, token)
+
+    # Try to link billing (ignore failure if already linked or permission-limited)
+    if billing_account_id:
+        subprocess.run(
+            ["gcloud", "billing", "projects", "link", pid, "--billing-account", billing_account_id],
+            check=False, capture_output=True, text=True
+        )
+
+    # Ensure Compute Engine (and any other required) APIs are on
+    enable_gcp_services(quiet=True, project_id=pid)
+    return pid
+
+
+def first_prepared_project(candidates: list[str], billing_account_id: str | None,
+                           max_workers: int = 8, verbose: bool = False) -> str | None:
+    """
+    Return the first of (at most GCP_MAX_PROJECT_CANDIDATES) candidates that can be prepared, or None.
+    Only the read-only access checks run concurrently; billing/API changes are made one project at a
+    time, in the order the checks pass, so no project but the winner (or one that failed) is touched.
+    The winner becomes the active gcloud project. One gcloud access token is shared by all calls.
+    """
+    prepared = None
+    token = gcloud_access_token()
+    ex = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futs = {ex.submit(_check_project_access, pid, token): pid
+                for pid in candidates[:GCP_MAX_PROJECT_CANDIDATES]}
+        for fut in as_completed(futs):
+            pid = futs[fut]
+            try:
+                fut.result()
+                prepared = _prepare_project(pid, billing_account_id, token)
+                break
+            except (subprocess.CalledProcessError, requests.exceptions.RequestException, RuntimeError) as e:
+                if verbose:
+                    print(f"↪️  Skipping '{pid}' (failed to prepare: {e}). Trying another...")
+                continue
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    if prepared:
+        try:
+            if verbose:
+                print(f"$ gcloud config set project {prepared}")
+            subprocess.run(["gcloud", "config", "set", "project", prepared], check=True, capture_output=True, text=True)
         except subprocess.CalledProcessError:
-            # Try next candidate
-            continue
+            return None
+    return prepared
 
-    return None
 
+def pick_random_existing_project(billing_account_id: str | None, verbose: bool = False) -> str | None:
+    """
+    Returns a usable existing projectId at random, or None if none work.
+    A project is considered usable if:
+      - we can `gcloud projects describe <id>`
+      - billing is linked (we try to link; it's fine if already linked)
+      - Compute Engine API can be enabled
+    Candidates are tried concurrently; the first usable one is set as the active gcloud project.
+    """
+    # Get active projects the caller can see
+    projects = list_active_projects(gcloud_access_token())
+    if not projects:
+        if verbose:
+            print("❌ No ACTIVE projects available to reuse.")
+        return None
+
+    random.shuffle(projects)
+    return first_prepared_project(projects, billing_account_id, verbose=verbose)
+
+
+def clean_non_aws_leftovers(output_dir: Path):
+    """
+    Make output_dir safe for an AWS run after a GCP/Azure run in the same folder: clear .terraform/ and
+    the lock file if they pin google/azurerm, delete leftover non-AWS .tf files, and move aside state
+    that holds non-AWS resources. Idempotent, so it runs both before a background init and in deploy_on_aws.
+    """
+    # Keep .terraform/ and the lock file between AWS runs; only clear them if they pin other providers
+    tf_dir = output_dir / ".terraform"
+    tf_lock = output_dir / ".terraform.lock.hcl"
+    try:
+        lock_txt = tf_lock.read_text()
+    except OSError:
+        lock_txt = ""
+    if "hashicorp/azurerm" in lock_txt or "hashicorp/google" in lock_txt:
+        print("🧹 Removing previous .terraform directory and lock file from a non-AWS run...")
+        shutil.rmtree(tf_dir, ignore_errors=True)
+        try:
+            tf_lock.unlink()
+        except Exception:
+            pass
 
-def purge_non_aws_tf_files(output_dir: Path):
-    """Delete any *.tf file in output_dir that mentions azurerm/google providers."""
-    for p in output_dir.glob("*.tf"):
+    # Purge leftover Azure/GCP .tf files in this folder (defense-in-depth)
+    for p in output_dir.iterdir():
+        if p.suffix != ".tf":
+            continue
         try:
             txt = p.read_text()
         except Exception:
             continue
-        if "azurerm" in txt or 'provider "azurerm"' in txt or "google" in txt or 'provider "google"' in txt:
+        if ('provider "azurerm"' in txt) or ("azurerm_" in txt) or ('provider "google"' in txt) or ("google_compute_" in txt):
             print(f"🧹 Removing leftover non-AWS file: {p.name}")
             try:
                 p.unlink()
             except Exception:
                 pass
 
-def backup_and_remove_state_if_non_aws(output_dir: Path):
-    """If terraform.tfstate contains any non-AWS resources, back it up and remove it."""
-    sp = output_dir / "terraform.tfstate"
-    if not sp.exists():
-        return
-    try:
-        data = json.loads(sp.read_text())
-    except Exception:
-        # if unreadable, be safe and move aside
-        new = output_dir / f"terraform.tfstate.backup"
-        print(f"🧳 Backing up unreadable state -> {new.name}")
-        sp.replace(new)
-        return
-    # scan resource types; AWS resources have types like "aws_instance", "aws_security_group", etc.
-    non_aws = []
-    for res in (data.get("resources") or []):
-        t = res.get("type", "")
-        if not t.startswith("aws_"):
-            non_aws.append(t)
-    if non_aws:
-        new = output_dir / "terraform.tfstate.azure_or_gcp.backup"
-        print(f"🧳 Found non-AWS resources in state {set(non_aws)}; backing up -> {new.name}")
-        sp.replace(new)
+    # Backup/remove state if it references non-AWS resources
+    state_path = output_dir / "terraform.tfstate"
+    if state_path.exists():
+        try:
+            data = json.loads(state_path.read_text())
+            non_aws = []
+            for res in (data.get("resources") or []):
+                t = res.get("type", "")
+                if not t.startswith("aws_"):
+                    non_aws.append(t)
+            if non_aws:
+                backup = output_dir / "terraform.tfstate.azure_or_gcp.backup"
+                print(f"🧳 Found non-AWS resources in state {set(non_aws)}; backing up -> {backup.name}")
+                state_path.replace(backup)
+        except Exception:
+            backup = output_dir / "terraform.tfstate.backup"
+            print(f"🧳 State unreadable; backing up -> {backup.name}")
+            try:
+                state_path.replace(backup)
+            except Exception:
+                pass
+
+
+def _sizing_cache_path() -> Path:
+    return CACHE_DIR / "sizing.json"
 
 
 def choose_aws_instance_type(app_type: str | None, region: str) -> str:
     """
     Ask the LLM to recommend a widely-available AWS instance type for our app.
     Returns a string like 't3.small' with a conservative fallback.
+    Answers are remembered per (app_type, region) in CACHE_DIR/sizing.json, so repeat runs skip the call.
     """
+    key = f"{(app_type or '').lower()}|{region}"
+    try:
+        sizing = _json_loads(_sizing_cache_path().read_bytes())
+    except (OSError, ValueError):
+        sizing = {}
+    if _INSTANCE_TYPE_RE.fullmatch(sizing.get(key) or ""):
+        return sizing[key]
+
     system = (
         "You are a cloud sizing assistant. Pick a broadly available AWS EC2 instance type "
         "that is cost-effective for a small web app (CPU only). Prefer t3 for x86, or t4g if "
         "the user explicitly targets ARM. Avoid GPU. Output ONLY JSON: {\"instance_type\":\"...\"}."
     )
-    user = json.dumps({
+    user = compact_json({
         "app_type": app_type or "generic web app",
         "region": region
     })
@@ -807,12 +1514,21 @@ def choose_aws_instance_type(app_type: str | None, region: str) -> str:
     try:
         ans = chat_complete(
             [{"role": "system", "content": system}, {"role": "user", "content": user}],
-            model=None, provider=None, timeout=45
+            model=None, provider=None, timeout=45, max_tokens=40, response_format=_JSON_MODE
         )
-        if ans and ans.strip().startswith("{"):
-            picked = json.loads(ans).get("instance_type", "").strip()
+        if ans:
+            picked = loads_llm_json(ans).get("instance_type", "").strip()
             # Basic sanity
-            if re.fullmatch(r"[a-z0-9]+\.[a-z0-9]+", picked):
+            if _INSTANCE_TYPE_RE.fullmatch(picked):
+                sizing[key] = picked
+                try:
+                    path = _sizing_cache_path()
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+                    tmp.write_text(compact_json(sizing))
+                    os.replace(tmp, path)  # atomic: concurrent runs never see a torn file
+                except OSError:
+                    pass  # cache is best-effort
                 return picked
     except Exception:
         pass
@@ -821,378 +1537,497 @@ def choose_aws_instance_type(app_type: str | None, region: str) -> str:
     return "t3.small"
 
 
-def main():
-    print("=== Autodeploy Chat System: Full Deployment Workflow ===\n")
+def az_ready(ttl: int = 3600) -> bool:
+    """True if the Azure CLI is installed and logged in. A success is stamped under CACHE_DIR for ttl seconds."""
+    stamp = CACHE_DIR / "az_ok"
+    try:
+        if time.time() - stamp.stat().st_mtime < ttl:
+            return True
+    except OSError:
+        pass
+    if shutil.which("az") is None:
+        return False
+    if subprocess.run(["az", "account", "show"], check=False, capture_output=True).returncode != 0:
+        return False
+    try:
+        stamp.parent.mkdir(parents=True, exist_ok=True)
+        stamp.touch()
+    except OSError:
+        pass
+    return True
 
-    # --- 1) User Input & LLM Intent Parsing ---
-    user_prompt = safe_input("Describe your deployment (e.g., 'Deploy my Flask app on GCP')")
-    repo_url = safe_input("GitHub repo URL", "https://github.com/Arvo-AI/hello_world")
-    repo_name = repo_name_from_url(repo_url)
-    owner = urlparse(repo_url).path.split('/')[1]
 
-    system_message_intent = """
-    You are a highly specialized AI assistant for a cloud deployment system. Your task is to extract and **normalize** key information from a user's request.
+# ---------------- Per-provider deployment ----------------
+def deploy_on_gcp(app_port: int, repo_name: str, output_dir: Path, app_type: str | None = None,
+                  init_proc: subprocess.Popen | None = None) -> str:
+    """Create/reuse a GCP project, then terraform init/apply in output_dir. Returns the VM public IP."""
+    billing_account_id = os.getenv("GCP_BILLING_ACCOUNT_ID")
+    if not billing_account_id:
+        print("❌ Billing account ID not provided. Aborting.")
+        sys.exit(1)
 
-    **Rules:**
-    - Identify the target **cloud provider**. Correct any typos or abbreviations to the full, standardized name (e.g., 'AWS', 'GCP', 'Azure').
-    - Identify the application **framework or type**. Correct any typos or abbreviations to the full, standardized name (e.g., 'Flask', 'Django', 'Node.js', 'Java').
-    - If a specific cloud provider or app type is not mentioned, return `null`.
+    # Try to create a new project first; on quota, reuse a random ACTIVE project.
+    new_project_id = "autodeploy-proj-" + "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
+    effective_project_id = new_project_id
 
-    **Response Format:**
-    Respond with a single JSON object with these two keys: `cloud_provider` and `app_type`. No extra text or formatting.
-    """
-    messages_intent = [
-        {"role": "system", "content": system_message_intent},
-        {"role": "user", "content": user_prompt},
-    ]
+    print(f"--- Creating New GCP Project: {new_project_id} ---")
+    print(f"$ gcloud projects create {new_project_id}")
+    create = subprocess.run(
+        ["gcloud", "projects", "create", new_project_id],
+        check=False, text=True, capture_output=True
+    )
 
-    print("Analyzing user request...")
-    llm_response_intent = chat_complete(messages_intent)
+    if create.returncode != 0:
+        if _QUOTA_RE.search(f"{create.stderr or ''}\n{create.stdout or ''}"):
+            print("⚠️ Project quota exceeded. Attempting to use a random existing ACTIVE project...")
+            prepared = pick_random_existing_project(billing_account_id, verbose=True)
+            if prepared:
+                effective_project_id = prepared
+                print(f"✅ Using existing project '{effective_project_id}'.")
+            else:
+                print("❌ Could not prepare any existing project (billing/API/permissions). Aborting.")
+                sys.exit(1)
+        else:
+            details = (create.stderr or "") + ("\n" + create.stdout if create.stdout else "")
+            print(f"❌ Failed to create GCP project. Details:\n{details}")
+            sys.exit(1)
+    else:
+        print(f"✅ Project '{new_project_id}' created.")
+        try:
+            print(f"$ gcloud billing projects link {new_project_id} --billing-account {billing_account_id}")
+            subprocess.run(
+                ["gcloud", "billing", "projects", "link", new_project_id, "--billing-account", billing_account_id],
+                check=True
+            )
+            print("✅ Project linked to billing account.")
 
-    if not llm_response_intent or not llm_response_intent.strip().startswith('{'):
-        print(f"❌ LLM returned an empty or invalid response. Response was: '{llm_response_intent}'")
-        sys.exit(1)
+            print(f"$ gcloud config set project {new_project_id}")
+            subprocess.run(["gcloud", "config", "set", "project", new_project_id], check=True)
+            print(f"✅ gcloud project set to '{new_project_id}'.")
 
-    extracted_info = json.loads(llm_response_intent)
-    cloud_provider = extracted_info.get('cloud_provider')
-    app_type = extracted_info.get('app_type')
-    print(f"✅ Intent parsed. Cloud Provider: {cloud_provider}, App Type: {app_type}")
+            # Fresh project: nothing is enabled yet, so skip the lookup
+            enable_gcp_services(skip_enabled=False)
+            print("✅ Compute Engine API enabled.")
+        except subprocess.CalledProcessError:
+            print("❌ Failed to configure new GCP project (see errors above).")
+            sys.exit(1)
 
-    # --- 2) LLM-Driven Repository Analysis ---
-    all_file_paths = get_repo_tree(owner, repo_name)
-    if not all_file_paths:
-        print("❌ Could not retrieve repository file list. Aborting.")
+    # Write TF (GCP) and apply
+    write_terraform_files("GCP", app_port, repo_name, output_dir, project_id=effective_project_id)
+
+    print("\n--- Executing Terraform commands (GCP) ---")
+    tf_env = terraform_env()
+    try:
+        if init_proc:
+            finish_terraform_init(init_proc, output_dir)
+        else:
+            subprocess.run(TF_INIT_CMD, cwd=output_dir, check=True, env=tf_env)
+        print("✅ Terraform init successful.")
+        save_terraform_lock("GCP", output_dir)
+        terraform_plan_and_apply(output_dir, tf_env)
+        print("✅ Terraform apply successful.")
+
+        public_ip = terraform_public_ip(output_dir, tf_env)
+        print(f"\n[✓] Application deployed and available at: http://{public_ip}/")
+    except subprocess.CalledProcessError as e:
+        print(f"❌ A Terraform command failed. Details:\n{e.stderr or e.stdout or ''}")
+        print("💡 Ensure you have the required CLI and are authenticated to GCP.")
         sys.exit(1)
 
-    system_message_files = """
-    You are a highly specialized AI assistant for analyzing application repositories. The user will provide a list of all file paths in a repository.
+    return public_ip
 
-    Your task is to identify the correct file path for each of the following:
-    1. The primary dependency file (e.g., 'requirements.txt', 'package.json', 'pom.xml').
-    2. The primary Dockerfile (e.g., 'Dockerfile').
-    3. The primary application entry point (e.g., 'app.py', 'server.js').
 
-    Return a single JSON object where keys are standardized file names ('Dockerfile', 'dependencies', 'entrypoint') and values are the correct file paths. If a file is not found, its value should be `null`.
+def deploy_on_azure(app_port: int, repo_name: str, output_dir: Path, app_type: str | None = None,
+                    init_proc: subprocess.Popen | None = None) -> str:
+    """Check Azure CLI login, then terraform init/apply in output_dir. Returns the VM public IP."""
+    # Ensure Azure CLI and login
+    if not az_ready():
+        if shutil.which("az") is None:
+            print("❌ Azure CLI (az) not found. Install it and run `az login`.")
+        else:
+            print("❌ Not logged into Azure. Run `az login` or configure a service principal.")
+        sys.exit(1)
 
-    Your response must be a valid, minified JSON object with no additional text or formatting.
-    """
-    messages_files = [
-        {"role": "system", "content": system_message_files},
-        {"role": "user", "content": json.dumps(all_file_paths)},
-    ]
+    # Write TF (Azure) and apply
+    try:
+        write_terraform_files("Azure", app_port, repo_name, output_dir)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
 
-    print("Analyzing repository file structure...")
-    llm_response_files = chat_complete(messages_files)
-    extracted_files = json.loads(llm_response_files)
-    print("✅ Repository files analyzed.")
+    print("\n--- Executing Terraform commands (Azure) ---")
+    tf_env = terraform_env()
+    try:
+        if init_proc:
+            finish_terraform_init(init_proc, output_dir)
+        else:
+            subprocess.run(TF_INIT_CMD, cwd=output_dir, check=True, env=tf_env)
+        print("✅ Terraform init successful.")
+        save_terraform_lock("Azure", output_dir)
+        terraform_plan_and_apply(output_dir, tf_env)
+        print("✅ Terraform apply successful.")
+
+        public_ip = terraform_public_ip(output_dir, tf_env)
+        print(f"\n[✓] Application deployed and available at: http://{public_ip}/")
+    except subprocess.CalledProcessError as e:
+        print(f"❌ A Terraform command failed. Details:\n{e.stderr or e.stdout or ''}")
+        print("💡 Ensure Terraform and Azure credentials are set correctly (subscription, SSH key, etc.).")
+        sys.exit(1)
 
-    # --- 3) Generate Startup Script via LLM and Write TF Bundle ---
-    output_dir = Path(f"./tf_out_{repo_name}")
-    output_dir.mkdir(parents=True, exist_ok=True)
+    return public_ip
 
-    startup_script_prompt = f"""
-    You are a specialized AI assistant for generating shell scripts to deploy applications on a clean Ubuntu VM. Here is a summary of the repository's key files: {json.dumps(extracted_files)}.
 
-    Your task is to generate a 'startup.sh' script that will:
-    1.  Clone the repository from GitHub: {repo_url}.
-    2.  Install the necessary language runtime and package manager (e.g., Python and pip, Node.js and npm).
-    3.  Install the application's dependencies.
-    4.  Run the application with the correct start command.
-    5.  Set any environment variables that are needed.
-    6.  Ensure the script is self-contained and runnable.
+def deploy_on_aws(app_port: int, repo_name: str, output_dir: Path, app_type: str | None = None,
+                  init_proc: subprocess.Popen | None = None) -> str:
+    """Check AWS CLI/credentials, size the instance, then terraform init/apply in output_dir. Returns the VM public IP."""
+    # Ensure AWS CLI and credentials
+    if shutil.which("aws") is None:
+        print("❌ AWS CLI not found. Install AWS CLI v2 and configure credentials.")
+        sys.exit(1)
+    if shutil.which("terraform") is None:
+        print("❌ terraform not found. Install Terraform and try again.")
+        sys.exit(1)
 
-    Respond with a single JSON object containing two keys:
-    1.  'startup_script': The full, plain-text content of the startup.sh script.
-    2.  'app_port': The most likely port the application runs on (e.g., 5000, 8000).
+    which_aws = shutil.which("aws")
+    ver = subprocess.run([which_aws, "--version"], check=False, capture_output=True, text=True)
+    print(f"ℹ️ Using AWS CLI at: {which_aws} -> {(ver.stdout or ver.stderr).strip()}")
 
-    Your response must be a valid, minified JSON object with no additional text or formatting.
-    """
-    messages_startup = [
-        {"role": "system", "content": startup_script_prompt},
-        {"role": "user", "content": json.dumps(extracted_files)},
-    ]
-
-    print("Generating startup script...")
-    llm_response_startup = chat_complete(messages_startup)
-    generated_config = json.loads(llm_response_startup)
-    startup_script = generated_config["startup_script"]
-    app_port = generated_config["app_port"]
-
-    startup_path = output_dir / "startup.sh"
-    startup_path.write_text(startup_script)
-    os.chmod(startup_path, 0o755)
-    print(f"✅ Startup script generated and saved to {startup_path}.")
-
-    # --- 4) Dynamic Provisioning & Deployment ---
-    # GCP path
-    if cloud_provider and re.search(r'\b(gcp|google\s+cloud|google\s+cloud\s+platform)\b', cloud_provider, flags=re.I):
-        billing_account_id = os.getenv("GCP_BILLING_ACCOUNT_ID")
-        if not billing_account_id:
-            print("❌ Billing account ID not provided. Aborting.")
-            sys.exit(1)
+    # Verify credentials
+    who = subprocess.run(["aws", "sts", "get-caller-identity"], check=False, capture_output=True, text=True)
+    if who.returncode != 0:
+        print("❌ AWS credentials not configured. Use `aws configure sso` (v2) or `aws configure`.")
+        print(who.stderr or who.stdout or "")
+        sys.exit(1)
 
-        # Try to create a new project first; on quota, reuse a random ACTIVE project.
-        new_project_id = "autodeploy-proj-" + "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
-        effective_project_id = new_project_id
+    # LLM picks instance type unless user already set AWS_INSTANCE_TYPE
+    region = os.getenv("AWS_REGION", "us-east-1")
+    inst_type = os.getenv("AWS_INSTANCE_TYPE")
+    if not inst_type:
+        inst_type = choose_aws_instance_type(app_type, region)
+        print(f"🤖 LLM-selected AWS instance type for region {region}: {inst_type}")
 
-        print(f"--- Creating New GCP Project: {new_project_id} ---")
-        print(f"$ gcloud projects create {new_project_id}")
-        create = subprocess.run(
-            ["gcloud", "projects", "create", new_project_id],
-            check=False, text=True, capture_output=True
-        )
+    # Write TF (AWS)
+    try:
+        write_terraform_files_aws(app_port, repo_name, output_dir, instance_type=inst_type)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
 
-        if create.returncode != 0:
-            combined = f"{create.stderr or ''}\n{create.stdout or ''}".lower()
-            if ("exceeded your allotted project quota" in combined) or ("quotafailure" in combined) or ("quota" in combined):
-                print("⚠️ Project quota exceeded. Attempting to use a random existing ACTIVE project...")
-                print("$ gcloud projects list --filter=lifecycleState=ACTIVE --format=value(projectId)")
-                lst = subprocess.run(
-                    ["gcloud", "projects", "list", "--filter=lifecycleState=ACTIVE", "--format=value(projectId)"],
-                    check=False, text=True, capture_output=True
-                )
-                candidates = [p.strip() for p in (lst.stdout or "").splitlines() if p.strip()]
-                if not candidates:
-                    print("❌ No ACTIVE projects available to reuse. Aborting.")
-                    sys.exit(1)
-
-                random.shuffle(candidates)
-                prepared = None
-                for pid in candidates:
-                    try:
-                        print(f"$ gcloud config set project {pid}")
-                        subprocess.run(["gcloud", "config", "set", "project", pid], check=True)
-
-                        if billing_account_id:
-                            print(f"$ gcloud billing projects link {pid} --billing-account {billing_account_id}")
-                            subprocess.run(
-                                ["gcloud", "billing", "projects", "link", pid, "--billing-account", billing_account_id],
-                                check=False
-                            )
-
-                        print("$ gcloud services enable compute.googleapis.com")
-                        subprocess.run(["gcloud", "services", "enable", "compute.googleapis.com"], check=True)
-
-                        prepared = pid
-                        break
-                    except subprocess.CalledProcessError:
-                        print(f"↪️  Skipping '{pid}' (failed to prepare). Trying another...")
-                        continue
-
-                if prepared:
-                    effective_project_id = prepared
-                    print(f"✅ Using existing project '{effective_project_id}'.")
-                else:
-                    print("❌ Could not prepare any existing project (billing/API/permissions). Aborting.")
-                    sys.exit(1)
-            else:
-                details = (create.stderr or "") + ("\n" + create.stdout if create.stdout else "")
-                print(f"❌ Failed to create GCP project. Details:\n{details}")
-                sys.exit(1)
+    clean_non_aws_leftovers(output_dir)
+
+    # Use a persistent plugin cache for reliable installs
+    tf_env = terraform_env()
+
+    print("\n--- Executing Terraform commands (AWS) ---")
+    try:
+        if init_proc:
+            finish_terraform_init(init_proc, output_dir)
         else:
-            print(f"✅ Project '{new_project_id}' created.")
-            try:
-                print(f"$ gcloud billing projects link {new_project_id} --billing-account {billing_account_id}")
-                subprocess.run(
-                    ["gcloud", "billing", "projects", "link", new_project_id, "--billing-account", billing_account_id],
-                    check=True
-                )
-                print("✅ Project linked to billing account.")
+            print(f"$ {' '.join(TF_INIT_CMD)}")
+            subprocess.run(TF_INIT_CMD, cwd=output_dir, check=True, env=tf_env)
+        print("✅ Terraform init successful.")
+        save_terraform_lock("AWS", output_dir)
 
-                print(f"$ gcloud config set project {new_project_id}")
-                subprocess.run(["gcloud", "config", "set", "project", new_project_id], check=True)
-                print(f"✅ gcloud project set to '{new_project_id}'.")
+        terraform_plan_and_apply(output_dir, tf_env)
+        print("✅ Terraform apply successful.")
 
-                print("$ gcloud services enable compute.googleapis.com")
-                subprocess.run(["gcloud", "services", "enable", "compute.googleapis.com"], check=True)
-                print("✅ Compute Engine API enabled.")
-            except subprocess.CalledProcessError:
-                print("❌ Failed to configure new GCP project (see errors above).")
-                sys.exit(1)
+        public_ip = terraform_public_ip(output_dir, tf_env)
 
-        # Write TF (GCP) and apply
-        write_terraform_files("GCP", app_port, repo_name, output_dir, project_id=effective_project_id)
+        print(f"\n[✓] Application deployed and available at: http://{public_ip}/")
+    except subprocess.CalledProcessError as e:
+        print(f"❌ A Terraform command failed. Details:\n{e.stderr or e.stdout or ''}")
+        print("💡 If it hung on provider install, macOS may have blocked the binary (Privacy & Security → Allow).")
+        print("💡 You can also retry with: TF_LOG=DEBUG terraform init -reconfigure -upgrade")
+        sys.exit(1)
 
-        print("\n--- Executing Terraform commands (GCP) ---")
-        try:
-            subprocess.run(["terraform", "init", "-reconfigure"], cwd=output_dir, check=True)
-            print("✅ Terraform init successful.")
-            subprocess.run(["terraform", "apply", "-auto-approve", "-input=false"], cwd=output_dir, check=True)
-            print("✅ Terraform apply successful.")
-
-            result = subprocess.run(
-                ["terraform", "output", "-json", "public_ip"],
-                cwd=output_dir, check=True, capture_output=True, text=True
-            )
-            try:
-                parsed = json.loads(result.stdout)
-                public_ip = parsed.get("value", parsed)
-            except Exception:
-                public_ip = result.stdout.strip().strip('"')
-            print(f"\n[✓] Application deployed and available at: http://{public_ip}/")
-        except subprocess.CalledProcessError as e:
-            print(f"❌ A Terraform command failed. Details:\n{e.stderr or e.stdout or ''}")
-            print("💡 Ensure you have the required CLI and are authenticated to GCP.")
-            sys.exit(1)
+    return public_ip
 
-    # Azure path
-    elif cloud_provider and re.search(r'\b(azure|microsoft\s+azure)\b', cloud_provider, flags=re.I):
-        # Ensure Azure CLI and login
-        if shutil.which("az") is None:
-            print("❌ Azure CLI (az) not found. Install it and run `az login`.")
-            sys.exit(1)
-        chk = subprocess.run(["az", "account", "show"], check=False, capture_output=True, text=True)
-        if chk.returncode != 0:
-            print("❌ Not logged into Azure. Run `az login` or configure a service principal.")
-            sys.exit(1)
 
-        # Write TF (Azure) and apply
-        try:
-            write_terraform_files("Azure", app_port, repo_name, output_dir)
-        except RuntimeError as e:
-            print(f"❌ {e}")
-            sys.exit(1)
+# Canonical provider name -> (name regex, deploy function); order is the match order
+_PROVIDERS = {
+    "GCP":   (_GCP_RE, deploy_on_gcp),
+    "Azure": (_AZURE_RE, deploy_on_azure),
+    "AWS":   (_AWS_RE, deploy_on_aws),
+}
 
-        print("\n--- Executing Terraform commands (Azure) ---")
-        try:
-            subprocess.run(["terraform", "init", "-reconfigure"], cwd=output_dir, check=True)
-            print("✅ Terraform init successful.")
-            subprocess.run(["terraform", "apply", "-auto-approve", "-input=false"], cwd=output_dir, check=True)
-            print("✅ Terraform apply successful.")
-
-            result = subprocess.run(
-                ["terraform", "output", "-json", "public_ip"],
-                cwd=output_dir, check=True, capture_output=True, text=True
-            )
-            try:
-                parsed = json.loads(result.stdout)
-                public_ip = parsed.get("value", parsed)
-            except Exception:
-                public_ip = result.stdout.strip().strip('"')
-            print(f"\n[✓] Application deployed and available at: http://{public_ip}/")
-        except subprocess.CalledProcessError as e:
-            print(f"❌ A Terraform command failed. Details:\n{e.stderr or e.stdout or ''}")
-            print("💡 Ensure Terraform and Azure credentials are set correctly (subscription, SSH key, etc.).")
-            sys.exit(1)
+def resolve_providers(cloud_provider) -> list[str]:
+    """Canonical provider names requested by the intent (a string such as "GCP and Azure", or a list)."""
+    names = cloud_provider if isinstance(cloud_provider, list) else [cloud_provider]
+    text = " ".join(str(n) for n in names if n)
+    return [p for p, (rx, _) in _PROVIDERS.items() if rx.search(text)]
 
-    # AWS path (LLM determines instance type; AZ chosen to support it in TF writer)
-    elif cloud_provider and re.search(r'\b(aws|amazon\s+web\s+services|amazon)\b', cloud_provider, flags=re.I):
-        # Ensure AWS CLI and credentials
-        if shutil.which("aws") is None:
-            print("❌ AWS CLI not found. Install AWS CLI v2 and configure credentials.")
-            sys.exit(1)
-        if shutil.which("terraform") is None:
-            print("❌ terraform not found. Install Terraform and try again.")
-            sys.exit(1)
 
-        which_aws = shutil.which("aws")
-        ver = subprocess.run([which_aws, "--version"], check=False, capture_output=True, text=True)
-        print(f"ℹ️ Using AWS CLI at: {which_aws} -> {(ver.stdout or ver.stderr).strip()}")
+# Well-known file names -> the key-file slot they fill (same slots the LLM is asked for)
+_KEY_FILE_NAMES = {
+    "Dockerfile": "Dockerfile",
+    **dict.fromkeys(("requirements.txt", "pyproject.toml", "Pipfile", "package.json", "pom.xml",
+                     "build.gradle", "go.mod", "Gemfile", "Cargo.toml"), "dependencies"),
+    **dict.fromkeys(("app.py", "main.py", "server.py", "wsgi.py", "manage.py",
+                     "server.js", "app.js", "index.js", "main.go"), "entrypoint"),
+}
+# The same table as one multiline regex (a named group per slot), so a single finditer over the
+# newline-joined tree classifies every path in C and Python only sees the handful of hits
+_KEY_FILE_RE = re.compile(
+    r"^(?:[^\n]*/)?(?:" + "|".join(
+        f"(?P<{slot}>" + "|".join(re.escape(n) for n, s in _KEY_FILE_NAMES.items() if s == slot) + ")"
+        for slot in ("Dockerfile", "dependencies", "entrypoint")
+    ) + r")$",
+    re.M,
+)
+
+def guess_key_files(all_file_paths: list[str]) -> dict | None:
+    """
+    Pick Dockerfile/dependencies/entrypoint from well-known file names without asking the LLM.
+    Per slot, only the shallowest matches count; returns None (ask the LLM) when a slot is ambiguous
+    or no dependency file or entrypoint was found.
+    """
+    found: dict[str, list[str]] = {}
+    for m in _KEY_FILE_RE.finditer("\n".join(all_file_paths)):
+        found.setdefault(m.lastgroup, []).append(m.group(0))
+
+    picked = {}
+    for slot in ("Dockerfile", "dependencies", "entrypoint"):
+        paths = found.get(slot, [])
+        depth = min((p.count("/") for p in paths), default=0)
+        shallowest = [p for p in paths if p.count("/") == depth]
+        if len(shallowest) > 1:
+            return None
+        picked[slot] = shallowest[0] if shallowest else None
+    if not (picked["dependencies"] and picked["entrypoint"]):
+        return None
+    return picked
+
+PROMPT_MAX_PATHS = 400
+# Vendored / generated trees never hold the files the prompts ask about
+_VENDORED_RE = re.compile(r"(?:^|/)(?:node_modules|vendor|bower_components|\.venv|venv|site-packages|__pycache__|dist)/")
 
-        # Verify credentials
-        who = subprocess.run(["aws", "sts", "get-caller-identity"], check=False, capture_output=True, text=True)
-        if who.returncode != 0:
-            print("❌ AWS credentials not configured. Use `aws configure sso` (v2) or `aws configure`.")
-            print(who.stderr or who.stdout or "")
-            sys.exit(1)
+def prompt_file_paths(all_file_paths: list[str], limit: int = PROMPT_MAX_PATHS) -> list[str]:
+    """
+    The repository paths worth sending to the LLM, most important first: well-known key-file
+    names, then the rest shallowest-first, with vendored trees dropped and the list capped at
+    `limit` (a plain prefix of a large monorepo tree can miss the files that matter).
+    """
+    key_paths = [m.group(0) for m in _KEY_FILE_RE.finditer("\n".join(all_file_paths))
+                 if not _VENDORED_RE.search(m.group(0))]
+    key_set = frozenset(key_paths)
+    rest = sorted((p for p in all_file_paths if p not in key_set and not _VENDORED_RE.search(p)),
+                  key=lambda p: p.count("/"))
+    return (sorted(key_paths, key=lambda p: p.count("/")) + rest)[:limit]
+
+
+def plan_deployment_batched(user_prompt: str, repo_url: str, all_file_paths: list[str]) -> dict:
+    """
+    One LLM call covering intent parsing, key-file analysis and startup.sh generation.
+    Returns {"intent": {...}, "files": {...}, "startup": {...}} with the same inner shapes
+    as the three separate prompts in main().
+    """
+    system = f"""
+    You are a highly specialized AI assistant for a cloud deployment system. Complete all three tasks below in one response.
+
+    Task "intent": extract and normalize from the user's request the target cloud provider ('AWS', 'GCP', 'Azure') and the application framework or type ('Flask', 'Django', 'Node.js', 'Java'), correcting typos and abbreviations. Use `null` for anything not mentioned.
+
+    Task "files": from the repository file paths, identify the primary dependency file (e.g., 'requirements.txt', 'package.json', 'pom.xml'), the primary Dockerfile, and the primary application entry point (e.g., 'app.py', 'server.js'). Use `null` for any file not found.
+
+    Task "startup": generate a 'startup.sh' script for a clean Ubuntu VM that shallow-clones {repo_url} (`git clone --depth 1 --single-branch`), installs the language runtime and package manager (all OS packages in one `apt-get install -y --no-install-recommends -o Dpkg::Use-Pty=0` after a single `apt-get update`; Node.js as `nodejs npm` from the Ubuntu archive, never a piped NodeSource setup script), installs the application's dependencies (Python: `pip install --prefer-binary --no-compile`), sets any needed environment variables, and runs the application with the correct start command. The script must be self-contained and runnable. Also give the most likely port the application runs on.
+
+    Respond with a single valid, minified JSON object with no additional text or formatting, exactly in this shape:
+    {{"intent":{{"cloud_provider":...,"app_type":...}},"files":{{"Dockerfile":...,"dependencies":...,"entrypoint":...}},"startup":{{"startup_script":"...","app_port":...}}}}
+    """
+    user = compact_json({"request": user_prompt, "file_paths": prompt_file_paths(all_file_paths)})
+    ans = chat_complete([{"role": "system", "content": system}, {"role": "user", "content": user}],
+                        stream=True, response_format=_JSON_MODE)
+    try:
+        plan = loads_llm_json(ans)
+    except ValueError:
+        plan = None
+    if not isinstance(plan, dict):
+        raise RuntimeError(f"LLM returned an empty or invalid response. Response was: '{ans}'")
+    return plan
+
+
+def main():
+    print("=== Autodeploy Chat System: Full Deployment Workflow ===\n")
+    threading.Thread(target=_http2_client, daemon=True).start()  # import httpx while the user types
+
+    # --- 1) User Input & LLM Intent Parsing ---
+    user_prompt = safe_input("Describe your deployment (e.g., 'Deploy my Flask app on GCP')")
+    repo_url = safe_input("GitHub repo URL", "https://github.com/Arvo-AI/hello_world")
+    try:
+        owner, repo_name, ref = parse_github_url(repo_url)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+    # AUTODEPLOY_BATCH_LLM=1 folds intent, file analysis and startup generation into one call
+    batch_llm = os.getenv("AUTODEPLOY_BATCH_LLM") == "1"
+
+    if not batch_llm:
+        system_message_intent = """
+        You are a highly specialized AI assistant for a cloud deployment system. Your task is to extract and **normalize** key information from a user's request.
+
+        **Rules:**
+        - Identify the target **cloud provider**. Correct any typos or abbreviations to the full, standardized name (e.g., 'AWS', 'GCP', 'Azure').
+        - Identify the application **framework or type**. Correct any typos or abbreviations to the full, standardized name (e.g., 'Flask', 'Django', 'Node.js', 'Java').
+        - If a specific cloud provider or app type is not mentioned, return `null`.
+        - If the user asks for more than one cloud provider, return `cloud_provider` as a list of names.
+
+        **Response Format:**
+        Respond with a single JSON object with these two keys: `cloud_provider` and `app_type`. No extra text or formatting.
+        """
+        messages_intent = [
+            {"role": "system", "content": system_message_intent},
+            {"role": "user", "content": user_prompt},
+        ]
+
+        # The intent call only needs the prompt, so run it in the background while the
+        # repo tree is fetched; its answer picks the providers whose init starts before the script call.
+        print("Analyzing user request...")
+        llm_pool = ThreadPoolExecutor(max_workers=1)
+        intent_future = llm_pool.submit(chat_complete, messages_intent, max_tokens=60, response_format=_JSON_MODE)
+        llm_pool.shutdown(wait=False)
 
-        # LLM picks instance type unless user already set AWS_INSTANCE_TYPE
-        region = os.getenv("AWS_REGION", "us-east-1")
-        inst_type = os.getenv("AWS_INSTANCE_TYPE")
-        if not inst_type:
-            inst_type = choose_aws_instance_type(app_type, region)
-            print(f"🤖 LLM-selected AWS instance type for region {region}: {inst_type}")
-            os.environ["AWS_INSTANCE_TYPE"] = inst_type  # used by the TF writer
+    # --- 2) LLM-Driven Repository Analysis ---
+    all_file_paths = get_repo_tree(owner, repo_name, ref or "main")
+    if not all_file_paths:
+        print("❌ Could not retrieve repository file list. Aborting.")
+        sys.exit(1)
 
-        # Write TF (AWS)
+    if batch_llm:
+        print("Analyzing request and repository, generating startup script (single LLM call)...")
         try:
-            write_terraform_files_aws(app_port, repo_name, output_dir)
+            plan = plan_deployment_batched(user_prompt, repo_url, all_file_paths)
         except RuntimeError as e:
             print(f"❌ {e}")
             sys.exit(1)
+        extracted_info = plan.get("intent") or {}
+        extracted_files = plan.get("files") or {}
+        generated_config = plan.get("startup") or {}
+    else:
+        llm_response_intent = intent_future.result()
+        try:
+            extracted_info = loads_llm_json(llm_response_intent)
+        except ValueError:
+            print(f"❌ LLM returned an empty or invalid response. Response was: '{llm_response_intent}'")
+            sys.exit(1)
 
-        # Clean any stale TF state from previous cloud runs in this folder
-        tf_dir = output_dir / ".terraform"
-        tf_lock = output_dir / ".terraform.lock.hcl"
-        if tf_dir.exists():
-            print("🧹 Removing previous .terraform directory to avoid stale provider locks...")
-            shutil.rmtree(tf_dir, ignore_errors=True)
-        if tf_lock.exists():
-            print("🧹 Removing previous .terraform.lock.hcl...")
-            try:
-                tf_lock.unlink()
-            except Exception:
-                pass
-
-        # Purge leftover Azure/GCP .tf files in this folder (defense-in-depth)
-        for p in output_dir.glob("*.tf"):
-            try:
-                txt = p.read_text()
-            except Exception:
-                continue
-            if ('provider "azurerm"' in txt) or ("azurerm_" in txt) or ('provider "google"' in txt) or ("google_compute_" in txt):
-                print(f"🧹 Removing leftover non-AWS file: {p.name}")
-                try:
-                    p.unlink()
-                except Exception:
-                    pass
-
-        # Backup/remove state if it references non-AWS resources
-        state_path = output_dir / "terraform.tfstate"
-        if state_path.exists():
-            try:
-                data = json.loads(state_path.read_text())
-                non_aws = []
-                for res in (data.get("resources") or []):
-                    t = res.get("type", "")
-                    if not t.startswith("aws_"):
-                        non_aws.append(t)
-                if non_aws:
-                    backup = output_dir / "terraform.tfstate.azure_or_gcp.backup"
-                    print(f"🧳 Found non-AWS resources in state {set(non_aws)}; backing up -> {backup.name}")
-                    state_path.replace(backup)
-            except Exception:
-                backup = output_dir / "terraform.tfstate.backup"
-                print(f"🧳 State unreadable; backing up -> {backup.name}")
-                try:
-                    state_path.replace(backup)
-                except Exception:
-                    pass
+    cloud_provider = extracted_info.get('cloud_provider')
+    app_type = extracted_info.get('app_type')
+    print(f"✅ Intent parsed. Cloud Provider: {cloud_provider}, App Type: {app_type}")
 
-        # Use a persistent plugin cache for reliable installs
-        tf_env = os.environ.copy()
-        tf_env.setdefault("TF_PLUGIN_CACHE_DIR", os.path.expanduser("~/.terraform.d/plugin-cache"))
-        os.makedirs(tf_env["TF_PLUGIN_CACHE_DIR"], exist_ok=True)
+    # --- 3) Generate Startup Script via LLM and Write TF Bundle ---
+    output_dir = Path(f"./tf_out_{repo_name}")
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-        print("\n--- Executing Terraform commands (AWS) ---")
-        try:
-            print("$ terraform init -reconfigure -upgrade")
-            subprocess.run(["terraform", "init", "-reconfigure", "-upgrade"], cwd=output_dir, check=True, env=tf_env)
-            print("✅ Terraform init successful.")
+    # One working dir per provider when several are requested, so their Terraform states stay apart
+    providers = resolve_providers(cloud_provider)
+    provider_dirs = {p: (output_dir / p.lower() if len(providers) > 1 else output_dir) for p in providers}
 
-            print("$ terraform apply -auto-approve -input=false")
-            subprocess.run(["terraform", "apply", "-auto-approve", "-input=false"], cwd=output_dir, check=True, env=tf_env)
-            print("✅ Terraform apply successful.")
+    # Kick off `terraform init` now; it runs while the startup script is generated
+    init_procs = {}
+    for p, p_dir in provider_dirs.items():
+        p_dir.mkdir(parents=True, exist_ok=True)
+        init_procs[p] = start_terraform_init(p, p_dir)
 
-            result = subprocess.run(
-                ["terraform", "output", "-json", "public_ip"],
-                cwd=output_dir, check=True, capture_output=True, text=True, env=tf_env
-            )
+    # Everything below may fail or exit; never leave a background `terraform init` running
+    try:
+        if not batch_llm:
+            # Obvious layouts (one requirements.txt, one app.py, ...) need no model to find the key files;
+            # the prompt then carries just those three paths instead of the whole tree
+            key_files = guess_key_files(all_file_paths)
+            if key_files:
+                repo_context = "The user will provide a summary of the repository's key files."
+            else:
+                repo_context = """The user will provide a list of all file paths in the repository.
+
+        First identify the primary dependency file (e.g., 'requirements.txt', 'package.json', 'pom.xml'), the primary Dockerfile (e.g., 'Dockerfile') and the primary application entry point (e.g., 'app.py', 'server.js'). Use `null` for any file not found."""
+
+            startup_script_prompt = f"""
+        You are a specialized AI assistant for generating shell scripts to deploy applications on a clean Ubuntu VM. {repo_context}
+
+        Then generate a 'startup.sh' script that will:
+        1.  Clone the repository from GitHub: {repo_url}, shallow (`git clone --depth 1 --single-branch`); only HEAD is needed.
+        2.  Install the necessary language runtime and package manager (e.g., Python and pip, Node.js and npm), with all OS packages in a single `apt-get install -y --no-install-recommends -o Dpkg::Use-Pty=0 ...` after one `apt-get update`. Install Node.js as `nodejs npm` from the Ubuntu archive in that same install; never pipe a remote setup script (such as NodeSource's) into bash.
+        3.  Install the application's dependencies (for Python, `pip install --prefer-binary --no-compile -r ...` so wheels are preferred over source builds).
+        4.  Run the application with the correct start command.
+        5.  Set any environment variables that are needed.
+        6.  Ensure the script is self-contained and runnable.
+
+        Respond with a single JSON object containing three keys:
+        1.  'files': An object mapping 'Dockerfile', 'dependencies' and 'entrypoint' to the key file paths.
+        2.  'startup_script': The full, plain-text content of the startup.sh script.
+        3.  'app_port': The most likely port the application runs on (e.g., 5000, 8000).
+
+        Your response must be a valid, minified JSON object with no additional text or formatting.
+        """
+            messages_startup = [
+                {"role": "system", "content": startup_script_prompt},
+                {"role": "user", "content": compact_json(key_files or prompt_file_paths(all_file_paths))},
+            ]
+
+            # Key-file analysis (when still needed) and script generation share one call
+            print("Analyzing repository file structure and generating startup script...")
+            llm_response_startup = chat_complete(messages_startup, stream=True, response_format=_JSON_MODE)
             try:
-                parsed = json.loads(result.stdout)
-                public_ip = parsed.get("value", parsed)
-            except Exception:
-                public_ip = result.stdout.strip().strip('"')
-
-            print(f"\n[✓] Application deployed and available at: http://{public_ip}/")
-        except subprocess.CalledProcessError as e:
-            print(f"❌ A Terraform command failed. Details:\n{e.stderr or e.stdout or ''}")
-            print("💡 If it hung on provider install, macOS may have blocked the binary (Privacy & Security → Allow).")
-            print("💡 You can also retry with: TF_LOG=DEBUG terraform init -reconfigure -upgrade")
+                generated_config = loads_llm_json(llm_response_startup)
+            except ValueError:
+                print(f"❌ LLM returned an empty or invalid response. Response was: '{llm_response_startup}'")
+                sys.exit(1)
+            if not isinstance(generated_config, dict):
+                generated_config = {}
+            extracted_files = key_files or generated_config.get("files") or {}
+
+        # The model may answer with a non-object for "files"/"startup"; treat that as missing
+        if not isinstance(extracted_files, dict):
+            extracted_files = {}
+        if not isinstance(generated_config, dict):
+            generated_config = {}
+
+        # The tree is the source of truth: null out any key-file path the model made up (O(1) lookups)
+        known_paths = frozenset(all_file_paths)
+        extracted_files = {k: (v if isinstance(v, str) and v in known_paths else None)
+                           for k, v in extracted_files.items()}
+        print(f"✅ Repository files analyzed: {compact_json(extracted_files)}")
+
+        startup_script = generated_config.get("startup_script")
+        if not isinstance(startup_script, str) or not startup_script.strip():
+            print("❌ LLM response did not include a startup script. Aborting.")
             sys.exit(1)
-
-    else:
-        print(f"❌ Deployment for {cloud_provider} not yet supported.")
+        app_port = prefer_port(generated_config.get("app_port"))
+
+        # One copy per provider directory; the writes overlap in write_files' thread pool
+        startup_paths = [p_dir / "startup.sh" for p_dir in (provider_dirs.values() or [output_dir])]
+        write_files(dict.fromkeys(startup_paths, startup_script))
+        for startup_path in startup_paths:
+            os.chmod(startup_path, 0o755)
+            print(f"✅ Startup script generated and saved to {startup_path}.")
+
+        # --- 4) Dynamic Provisioning & Deployment ---
+        if not providers:
+            print(f"❌ Deployment for {cloud_provider} not yet supported.")
+        elif len(providers) == 1:
+            p = providers[0]
+            _PROVIDERS[p][1](app_port, repo_name, provider_dirs[p], app_type, init_procs.get(p))
+        else:
+            # Multi-cloud: each provider has its own working dir/state, so their applies run side by side
+            print(f"\n--- Deploying to {', '.join(providers)} in parallel ---")
+            failed = []
+            with ThreadPoolExecutor(max_workers=len(providers)) as ex:
+                futs = {
+                    ex.submit(_PROVIDERS[p][1], app_port, repo_name, provider_dirs[p], app_type, init_procs.get(p)): p
+                    for p in providers
+                }
+                for fut in as_completed(futs):
+                    try:
+                        print(f"[✓] {futs[fut]}: http://{fut.result()}/")
+                    except SystemExit:  # the deploy function already printed why
+                        failed.append(futs[fut])
+            if failed:
+                print(f"❌ Deployment failed for: {', '.join(failed)}")
+                sys.exit(1)
+    finally:
+        for proc in init_procs.values():
+            if proc and proc.poll() is None:
+                proc.terminate()
 
 
 